@@ -8,49 +8,62 @@ from gym.spaces import Discrete, Box
 import numpy as np
 import zero_ad
 from os import path
-import json
 
 class BaseZeroADEnv(gym.Env):
     def __init__(self, config):
         self.step_count = 8
-        server_address = self.address(config.worker_index)
+        server_address = self.address(config)
         self.game = zero_ad.ZeroAD(server_address)
         self.prev_state = None
         self.state = None
         self.cum_reward = 0
+        self._player_states_cache = {}
 
-    def address(self, worker_index):
-        port = 5999 + worker_index
+    def address(self, config):
+        envs_per_worker = config.get('envs_per_worker', 1)
+        port = 5999 + config.worker_index * envs_per_worker + config.vector_index
         return f'http://127.0.0.1:{port}'
 
     def reset(self):
+        self.invalidate_caches()
         self.prev_state = self.game.reset(self.scenario_config())
         self.state = self.game.step([zero_ad.actions.reveal_map()])
         return self.observation(self.state)
 
     def step(self, action_index):
         action = self.resolve_action(action_index)
+        self.invalidate_caches(keep_state=self.state)
         self.prev_state = self.state
-        self.state = self.game.step([action])
-        for _ in range(self.step_count - 1):
-            self.state = self.game.step()
+        self.state = self.step_n([action], self.step_count)
 
-        player_states = [player['state'] for player in self.state.data['players']]
-        players_finished = [state != 'active' for state in player_states]
-        done = any(players_finished)
+        done = any(state != 'active' for state in self.player_states(self.state))
         reward = self.reward(self.prev_state, self.state)
         self.cum_reward += reward
         if done:
             stats = self.episode_complete_stats(self.state)
-            stats_str = ' '
-            for (k, v) in stats.items():
-                stats_str += k + ': ' + str(v) + '; '
-
-            print(f'episode complete.{stats_str}')
+            stats_str = '; '.join(f'{k}: {v}' for (k, v) in stats.items())
+            print(f'episode complete. {stats_str}')
             self.cum_reward = 0
 
         return self.observation(self.state), reward, done, {}
 
+    def step_n(self, actions, n):
+        """Advance the game n turns, sending the actions on the first one.
+
+        Only the last response is decoded into a game state; the
+        intermediate turns go straight through the RPC client.
+        """
+        if n == 1:
+            return self.game.step(actions)
+
+        player_id = self.game.player_id
+        self.game.api.step([(player_id, action) for action in actions if action is not None])
+        # Intermediate responses are discarded unparsed, so there is no client
+        # side work to overlap with these requests.
+        for _ in range(n - 2):
+            self.game.api.step([])
+        return self.game.step()
+
     def episode_complete_stats(self, state):
         stats = {}
         stats['reward'] = self.cum_reward
@@ -58,7 +71,14 @@ class BaseZeroADEnv(gym.Env):
         return stats
 
     def get_player_state(self, state, index):
-        return state.data['players'][index]['state']
+        return self.player_states(state)[index]
+
+    def player_states(self, state):
+        key = (id(state),)
+        if key not in self._player_states_cache:
+            players = state.data['players']
+            self._player_states_cache[key] = tuple(player['state'] for player in players)
+        return self._player_states_cache[key]
 
     def reward(self, prev_state, state):
         if self.get_player_state(state, 1) == 'defeated':
@@ -68,6 +88,14 @@ class BaseZeroADEnv(gym.Env):
         else:
             return 0
 
+    def invalidate_caches(self, keep_state=None):
+        self._evict_states(self._player_states_cache, keep_state)
+
+    def _evict_states(self, cache, keep_state):
+        keep = id(keep_state)
+        for key in [key for key in cache if key[0] != keep]:
+            del cache[key]
+
     def observation(self, state):
         pass
 
@@ -82,26 +110,35 @@ class CavalryVsInfantryEnv(BaseZeroADEnv):
         super().__init__(config)
         self.action_space = Discrete(2)
         self.observation_space = Box(0.0, 1.0, shape=(1, ), dtype=np.float32)
+        self._units_cache = {}
+        self._positions_cache = {}
+        self._centers_cache = {}
+        self._config_cache = {}
 
     def resolve_action(self, action_index):
         return self.retreat() if action_index == 0 else self.attack()
 
     def retreat(self):
-        units = self.state.units(owner=1)
-        center = self.center(units)
-        offset = self.enemy_offset(self.state)
-        rel_position = 20 * (offset / np.linalg.norm(offset, ord=2))
-        position = list(center - rel_position)
+        units = self._owned_units(self.state, 1)
+        center = self.center(self.state, 1)
+        offset_x, offset_z = self.center(self.state, 2) - center
+        dist = math.hypot(offset_x, offset_z)
+        if not dist > 0:
+            position = [float(center[0]), float(center[1])]
+        else:
+            scale = 20 / dist
+            position = [float(center[0]) - scale * offset_x, float(center[1]) - scale * offset_z]
         return zero_ad.actions.walk(units, *position)
 
     def attack(self):
-        units = self.state.units(owner=1)
-        center = self.center(units)
-
-        enemy_units = self.state.units(owner=2)
-        enemy_positions = np.array([unit.position() for unit in enemy_units])
-        dists = np.linalg.norm(enemy_positions - center, ord=2, axis=1)
-        closest_index = np.argmin(dists)
+        units = self._owned_units(self.state, 1)
+        center = self.center(self.state, 1)
+
+        enemy_units = self._owned_units(self.state, 2)
+        enemy_positions = self._positions(self.state, 2)
+        diff = enemy_positions - center
+        dists2 = np.einsum('ij,ij->i', diff, diff)
+        closest_index = int(dists2.argmin())
         closest_enemy = enemy_units[closest_index]
 
         return zero_ad.actions.attack(units, closest_enemy)
@@ -112,25 +149,54 @@ class CavalryVsInfantryEnv(BaseZeroADEnv):
     def scenario_config(self):
         configs_dir = path.join(path.dirname(path.realpath(__file__)), 'scenario-configs')
         filename = self.scenario_config_file()
-        config_path = path.join(configs_dir, filename)
-        with open(config_path) as f:
-            config = f.read()
-        return config
+        if filename not in self._config_cache:
+            config_path = path.join(configs_dir, filename)
+            with open(config_path) as f:
+                self._config_cache[filename] = f.read()
+        return self._config_cache[filename]
 
     def observation(self, state):
-        dist = np.linalg.norm(self.enemy_offset(state))
+        dist = math.hypot(*self.enemy_offset(state))
         max_dist = 80
-        normalized_dist = dist/max_dist if not np.isnan(dist/max_dist) else 1.
-        return np.array([min(normalized_dist, 1.)])
+        normalized_dist = dist/max_dist if not math.isnan(dist) else 1.
+        return np.array([min(normalized_dist, 1.)], dtype=np.float32)
 
     def enemy_offset(self, state):
-        player_units = state.units(owner=1)
-        enemy_units = state.units(owner=2)
-        return self.center(enemy_units) - self.center(player_units)
-
-    def center(self, units):
-        positions = np.array([unit.position() for unit in units])
-        return np.mean(positions, axis=0)
+        return self.center(state, 2) - self.center(state, 1)
+
+    def center(self, state, owner):
+        key = (id(state), owner)
+        if key not in self._centers_cache:
+            positions = self._positions(state, owner)
+            self._centers_cache[key] = positions.sum(axis=0) / len(positions)
+        return self._centers_cache[key]
+
+    def invalidate_caches(self, keep_state=None):
+        super().invalidate_caches(keep_state)
+        self._evict_states(self._units_cache, keep_state)
+        self._evict_states(self._positions_cache, keep_state)
+        self._evict_states(self._centers_cache, keep_state)
+
+    def _units(self, state):
+        key = (id(state),)
+        if key not in self._units_cache:
+            units = state.units()
+            owners = np.fromiter((unit.owner() for unit in units), dtype=int, count=len(units))
+            coords = (c for unit in units for c in unit.position())
+            positions = np.fromiter(coords, dtype=float, count=2 * len(units)).reshape(-1, 2)
+            self._units_cache[key] = (units, owners, positions)
+        return self._units_cache[key]
+
+    def _owned_units(self, state, owner):
+        units, owners, _ = self._units(state)
+        return [units[i] for i in np.flatnonzero(owners == owner)]
+
+    def _positions(self, state, owner):
+        key = (id(state), owner)
+        if key not in self._positions_cache:
+            _, owners, positions = self._units(state)
+            self._positions_cache[key] = positions[owners == owner]
+        return self._positions_cache[key]
 
 class SimpleMinimapCavVsInfEnv(CavalryVsInfantryEnv):
     def __init__(self, config):
@@ -138,20 +204,16 @@ class SimpleMinimapCavVsInfEnv(CavalryVsInfantryEnv):
         self.observation_space = Box(0.0, 1.0, shape=(84, 84, 3), dtype=np.float32)
 
     def observation(self, state):
-        obs = np.zeros((84, 84, 3))
-        my_units = state.units(owner=1)
-        center = self.center(my_units)
-        if len(my_units) > 0:
-            min_x = center[0] - 42
-            max_x = center[0] + 42
-            min_z = center[1] - 42
-            max_z = center[1] + 42
-            for unit in state.units():
-                pos = unit.position()
-                if min_x < pos[0] < max_x and min_z < pos[1] < max_z:
-                    x = int(pos[0] - min_x)
-                    z = int(pos[1] - min_z)
-                    obs[x][z][int(unit.owner())] = 1.
+        # RLlib keeps references to returned observations in its sample
+        # batches, so a buffer reused across steps would need copying anyway.
+        obs = np.zeros((84, 84, 3), dtype=np.float32)
+        _, owners, positions = self._units(state)
+        if len(self._positions(state, 1)) > 0:
+            center = self.center(state, 1)
+            offsets = positions - (center - 42)
+            visible = np.all((offsets > 0) & (offsets < 84), axis=1)
+            cells = offsets[visible].astype(np.int32)
+            obs[cells[:, 0], cells[:, 1], owners[visible]] = 1.
 
         return obs
 
@@ -161,6 +223,9 @@ class MinimapCavVsInfEnv(SimpleMinimapCavVsInfEnv):
         self.action_space = Discrete(9)
         self.level = config.get('level', 1)
         self.caution_factor = 10
+        angles = [2 * math.pi * i/8 for i in range(8)]
+        self.move_offsets = 15 * np.array([[math.cos(angle), math.sin(angle)] for angle in angles])
+        self._healths_cache = {}
 
     def on_train_result(self, mean_reward):
         max_reward = self.max_reward()
@@ -183,19 +248,27 @@ class MinimapCavVsInfEnv(SimpleMinimapCavVsInfEnv):
         if action_index == 8:
             return self.attack()
         else:
-            return self.move(2 * math.pi * action_index/8)
+            return self.move_by(self.move_offsets[action_index])
 
     def move(self, angle, distance=15):
-        units = self.state.units(owner=1)
-        center = self.center(units)
-
         offset = distance * np.array([math.cos(angle), math.sin(angle)])
-        position = list(center + offset)
+        return self.move_by(offset)
 
+    def move_by(self, offset):
+        units = self._owned_units(self.state, 1)
+        center = self.center(self.state, 1)
+        position = list(center + offset)
         return zero_ad.actions.walk(units, *position)
 
     def player_unit_health(self, state, owner=1):
-        return sum(( unit.health(True) for unit in state.units(owner=owner)))
+        key = (id(state), owner)
+        if key not in self._healths_cache:
+            self._healths_cache[key] = sum(unit.health(True) for unit in self._owned_units(state, owner))
+        return self._healths_cache[key]
+
+    def invalidate_caches(self, keep_state=None):
+        super().invalidate_caches(keep_state)
+        self._evict_states(self._healths_cache, keep_state)
 
     def reward(self, prev_state, state):
         return self.damage_diff(prev_state, state) - 0.0001
@@ -212,12 +285,12 @@ class MinimapCavVsInfEnv(SimpleMinimapCavVsInfEnv):
         prev_enemy_health = self.player_unit_health(prev_state, 2)
         enemy_health = self.player_unit_health(state, 2)
         enemy_damage = prev_enemy_health - enemy_health
-        assert(enemy_damage >= 0, f'Enemy damage is negative: {enemy_damage}')
+        assert enemy_damage >= 0, f'Enemy damage is negative: {enemy_damage}'
 
         prev_player_health = self.player_unit_health(prev_state)
         player_health = self.player_unit_health(state)
         player_damage = prev_player_health - player_health
-        assert(player_damage >= 0, f'Player damage is negative: {player_damage}')
+        assert player_damage >= 0, f'Player damage is negative: {player_damage}'
         return enemy_damage - self.caution_factor * player_damage
 
     def episode_complete_stats(self, state):
@@ -0,0 +1,41 @@
+"""
+    A VectorEnv which steps several 0 AD environments from one worker in parallel threads.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from ray.rllib.env.env_context import EnvContext
+from ray.rllib.env.vector_env import VectorEnv
+
+class ThreadedVectorEnv(VectorEnv):
+    def __init__(self, env_class, config, num_envs):
+        envs_per_worker = config.get('envs_per_worker', 1) * num_envs
+        env_config = dict(config, envs_per_worker=envs_per_worker)
+        self.envs = []
+        for i in range(num_envs):
+            vector_index = config.vector_index * num_envs + i
+            env_context = EnvContext(env_config, config.worker_index, vector_index)
+            self.envs.append(env_class(env_context))
+
+        self.num_envs = num_envs
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.executor = ThreadPoolExecutor(max_workers=num_envs)
+
+    def vector_reset(self):
+        return list(self.executor.map(lambda env: env.reset(), self.envs))
+
+    def reset_at(self, index):
+        return self.envs[index].reset()
+
+    def vector_step(self, actions):
+        results = list(self.executor.map(lambda env, action: env.step(action), self.envs, actions))
+        obs, rewards, dones, infos = zip(*results)
+        return list(obs), list(rewards), list(dones), list(infos)
+
+    def get_unwrapped(self):
+        return self.envs
+
+def make_env(env_class, config):
+    threaded_envs = config.get('threaded_envs', 1)
+    if threaded_envs > 1:
+        return ThreadedVectorEnv(env_class, config, threaded_envs)
+    return env_class(config)
@@ -5,10 +5,11 @@
 from ray.rllib.train import create_parser, run
 from ray.tune.registry import register_env
 from cav_vs_inf_env import *
+from threaded_vector_env import make_env
 
-register_env('CavalryVsInfantry', lambda c: CavalryVsInfantryEnv(c))
-register_env('SimpleMinimapCavVsInf', lambda c: SimpleMinimapCavVsInfEnv(c))
-register_env('MinimapCavVsInf', lambda c: MinimapCavVsInfEnv(c))
+register_env('CavalryVsInfantry', lambda c: make_env(CavalryVsInfantryEnv, c))
+register_env('SimpleMinimapCavVsInf', lambda c: make_env(SimpleMinimapCavVsInfEnv, c))
+register_env('MinimapCavVsInf', lambda c: make_env(MinimapCavVsInfEnv, c))
 
 def invoke_if_defined(obj, method, arg):
     fn = getattr(obj, method, None)